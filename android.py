@@ -1,7 +1,10 @@
 from datetime import datetime
+import hashlib
+import os
+import shlex
 import subprocess
+import threading
 import time
-import xmltodict
 import re
 import traceback
 
@@ -10,16 +13,54 @@ def _time_prefix():
     return datetime.now().strftime("%H:%M:%S")
 
 
-# TODO Maybe keep a shell process open to speed this up instead of having to call adb shell every time
+# Callbacks called with (event, details dictionary) when input is sent ("input"), the foreground tracker sees a
+# new foreground activity ("foreground") or a screenshot is saved ("screenshot"), e.g. to record a timeline.
+# Called right before the event happens (input) or right after (others), from the thread that produced it.
+event_listeners = []
+
+
+def _notify(event, **details):
+    for listener in event_listeners:
+        listener(event, details)
+
+
+# Function running a device shell command and returning (exit code, output), set by device_manager.use() to run
+# shell commands through a kept open connection with automatic recovery. None to run "adb shell" every time.
+shell_runner = None
+# Serial of the device adb commands go to, set by device_manager.use(). None for the only connected device.
+device_serial = None
+# Function running an adb command (list of arguments after "adb -s <serial>") to completion and returning its
+# CompletedProcess (with bytes stdout and stderr), set by device_manager.use() to recover from disconnections.
+# None to run adb directly.
+adb_runner = None
+
+
+def _adb(*args):
+    if device_serial is None:
+        return ['adb', *args]
+    return ['adb', '-s', device_serial, *args]
+
+
+def _run_adb(*args):
+    if adb_runner is not None:
+        return adb_runner(list(args))
+    return subprocess.run(_adb(*args), capture_output=True)
+
+
 def _run_adb_shell(command, assertion=True):
-    ret = subprocess.run(['adb', 'shell', command], capture_output=True)
+    if command.startswith('input '):
+        _notify('input', command=command)
+    if shell_runner is not None:
+        returncode = shell_runner(command)[0]
+    else:
+        returncode = _run_adb('shell', command).returncode
     if assertion:
-        assert ret.returncode == 0
+        assert returncode == 0
     time.sleep(0.3)
 
 
-def _run_command(command, assertion=True):
-    ret = subprocess.run(command, capture_output=False)
+def _run_command(*args, assertion=True):
+    ret = _run_adb(*args)
     if assertion:
         assert ret.returncode == 0
     time.sleep(0.3)
@@ -29,9 +70,22 @@ def _check_output(command):
     return subprocess.check_output(command, shell=True, text=True).strip()
 
 
-# TODO Maybe keep a shell process open to speed this up instead of having to call adb shell every time
+def _adb_check_output(*args):
+    ret = _run_adb(*args)
+    if ret.returncode != 0:
+        raise subprocess.CalledProcessError(ret.returncode, _adb(*args), ret.stdout, ret.stderr)
+    return ret.stdout.decode(errors='replace').strip()
+
+
 def _adb_shell_check_output(command):
-    return _check_output(f'adb shell {command}')
+    # Same word splitting and quote removal the host shell does for "adb shell <command>"
+    command = ' '.join(shlex.split(command))
+    if shell_runner is None:
+        return _adb_check_output('shell', command)
+    returncode, output = shell_runner(command)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, command, output)
+    return output.strip()
 
 
 def _view_hierarchy_xml():
@@ -39,13 +93,64 @@ def _view_hierarchy_xml():
     return _adb_shell_check_output('cat /sdcard/window_dump.xml')
 
 
+def screen_fingerprint():
+    """
+    Returns a hash of the current screen content.
+    The hash is computed in the device from the raw framebuffer, so it's much cheaper than a screenshot
+    or a view hierarchy dump. Useful to know if the screen changed.
+    Note that screens with secure content (e.g. FLAG_SECURE) are captured black, so they all have the same hash.
+    :return: Screen hash as hexadecimal string.
+    """
+    return _adb_shell_check_output('"screencap | md5sum"').split(' ')[0]
+
+
+def wait_for_screen_stable(timeout=5, interval=0.5, stable_checks=2):
+    """
+    Waits for the screen to stop changing (e.g. animations or loading to finish).
+    :param timeout: Timeout in seconds.
+    :param interval: Seconds between screen checks.
+    :param stable_checks: Number of consecutive checks the screen must stay the same.
+    :return: True if the screen was stable before the timeout, False otherwise.
+    """
+    deadline = time.time() + timeout
+    previous = screen_fingerprint()
+    unchanged = 0
+    while time.time() + interval <= deadline:
+        time.sleep(interval)
+        fingerprint = screen_fingerprint()
+        if fingerprint == previous:
+            unchanged += 1
+            if unchanged >= stable_checks:
+                return True
+        else:
+            unchanged = 0
+            previous = fingerprint
+    return False
+
+
+# If True, view_hierarchy() only dumps the view hierarchy again when the screen fingerprint changed.
+# Disabled by default since different screens with secure content have the same fingerprint.
+cache_view_hierarchy = False
+_view_hierarchy_cache = {
+    'fingerprint': None,
+    'hierarchy': None
+}
+
+
 def view_hierarchy():
     """
     Returns current screen view hierarchy.
+    If cache_view_hierarchy is True, returns the previous one if the screen didn't change.
     :return: Dictionary representing the current screen view hierarchy.
     """
-    xml = _view_hierarchy_xml()
-    return xmltodict.parse(xml)
+    import xmltodict
+    if not cache_view_hierarchy:
+        return xmltodict.parse(_view_hierarchy_xml())
+    fingerprint = screen_fingerprint()
+    if fingerprint != _view_hierarchy_cache['fingerprint']:
+        _view_hierarchy_cache['hierarchy'] = xmltodict.parse(_view_hierarchy_xml())
+        _view_hierarchy_cache['fingerprint'] = fingerprint
+    return _view_hierarchy_cache['hierarchy']
 
 
 def _print_stack_trace():
@@ -261,28 +366,109 @@ def unlock():
     time.sleep(0.3)
 
 
-def _dumpsys_activity():
-    return _check_output("adb shell dumpsys activity top | grep 'ACTIVITY' | tail -n 1")
+# Component in activity event log entries, e.g. "[0,com.example/.MainActivity,resumeTopActivity]"
+_event_component_pattern = re.compile(r'[\[,]([\w.]+)/([\w.$]+)')
+
+
+def _resumed_activity():
+    # Only the resumed activity lines, filtered in the device. Much lighter than dumping "activity top".
+    output = _adb_shell_check_output('"dumpsys activity activities | grep -E \'mResumedActivity|topResumedActivity\' || true"')
+    match = re.search(r'u\d+ ([\w.]+)/([\w.$]+)', output)
+    if match is None:
+        return None, None
+    return match.group(1), match.group(2)
+
+
+_foreground = {
+    'package': None,
+    'activity': None
+}
+_foreground_changed = threading.Condition()
+_foreground_tracker = {
+    'process': None,
+    'thread': None
+}
+
+
+def _foreground_tracker_running():
+    process = _foreground_tracker['process']
+    return process is not None and process.poll() is None
+
+
+def _track_foreground(process):
+    for line in process.stdout:
+        match = _event_component_pattern.search(line)
+        if match is not None:
+            with _foreground_changed:
+                _foreground['package'] = match.group(1)
+                _foreground['activity'] = match.group(2)
+                _foreground_changed.notify_all()
+            _notify('foreground', package=match.group(1), activity=match.group(2))
+
+
+def start_foreground_tracker():
+    """
+    Starts tracking the foreground app and activity in the background, from the activity events in the event log.
+    While running, current_app_name(), current_activity_name() and wait_for_activity() don't call adb at all.
+    :return: Nothing.
+    """
+    if _foreground_tracker_running():
+        return
+    package, activity = _resumed_activity()
+    with _foreground_changed:
+        _foreground['package'] = package
+        _foreground['activity'] = activity
+    process = subprocess.Popen(
+        _adb('logcat', '-b', 'events', '-T', '1', '-s', 'wm_set_resumed_activity', 'am_set_resumed_activity'),
+        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    thread = threading.Thread(target=_track_foreground, args=(process,), daemon=True)
+    thread.start()
+    _foreground_tracker['process'] = process
+    _foreground_tracker['thread'] = thread
+
+
+def stop_foreground_tracker():
+    """
+    Stops tracking the foreground app and activity.
+    :return: Nothing.
+    """
+    process = _foreground_tracker['process']
+    if process is None:
+        return
+    process.kill()
+    process.wait()
+    _foreground_tracker['thread'].join()
+    _foreground_tracker['process'] = None
+    _foreground_tracker['thread'] = None
+
+
+def _foreground_component():
+    if _foreground_tracker_running():
+        with _foreground_changed:
+            return _foreground['package'], _foreground['activity']
+    return _resumed_activity()
+
+
+def _activity_class_name(activity_name):
+    if activity_name is not None and activity_name.startswith('.'):
+        return activity_name.lstrip('.')
+    return activity_name
 
 
 def current_app_name():
     """
     Returns current foreground app name.
-    :return: App package name.
+    :return: App package name, or None if there is no foreground app.
     """
-    return re.search(r'ACTIVITY (.*)/.*', _dumpsys_activity()).group(1).strip()
+    return _foreground_component()[0]
 
 
 def current_activity_name():
     """
     Returns foreground activity (not canonical) class name.
-    :return: Activity class name.
+    :return: Activity class name, or None if there is no foreground activity.
     """
-    activity_name = re.search(r'ACTIVITY .*/(.*?) .*', _dumpsys_activity()).group(1).strip()
-    if activity_name.startswith('.'):
-        return activity_name.lstrip('.')
-    else:
-        return activity_name
+    return _activity_class_name(_foreground_component()[1])
 
 
 def clear(app_package):
@@ -496,10 +682,14 @@ def wait_for_activity(activity, timeout=5):
     Wait for an activity by class name to become the foreground activity.
     :param activity: Class name of the activity.
     :param timeout: Timeout in seconds.
-    :return:
+    :return: True if the activity became the foreground activity before the timeout, False otherwise.
     """
+    if _foreground_tracker_running():
+        with _foreground_changed:
+            return _foreground_changed.wait_for(
+                lambda: activity in (_activity_class_name(_foreground['activity']) or ''), timeout)
     for i in range(timeout):
-        if activity in current_activity_name():
+        if activity in (current_activity_name() or ''):
             return True
         else:
             time.sleep(1)
@@ -543,7 +733,7 @@ def install(apk_path):
     :param apk_path: Path of the APK to install
     :return: Nothing.
     """
-    _run_command(['adb', 'install', apk_path])
+    _run_command('install', apk_path)
 
 
 # TODO Return True/False if uninstall was successful or not
@@ -553,7 +743,152 @@ def uninstall(package):
     :param package: App package name to uninstall.
     :return: Nothing.
     """
-    _run_command(['adb', 'uninstall', package], assertion=False)
+    _run_command('uninstall', package, assertion=False)
+
+
+def devices():
+    """
+    Returns serials of the devices currently connected and online.
+    :return: List of device serials.
+    """
+    serials = []
+    for line in _check_output('adb devices').split('\n')[1:]:
+        fields = line.split()
+        if len(fields) >= 2 and fields[1] == 'device':
+            serials.append(fields[0])
+    return serials
+
+
+def _run_adb_for(serial, *args):
+    ret = subprocess.run(['adb', '-s', serial, *args], capture_output=True, text=True)
+    return ret.returncode, (ret.stdout + ret.stderr).strip()
+
+
+# Keyed by path, size and modification time so each APK is hashed once no matter how many devices it goes to
+_apk_hashes = {}
+
+
+def _apk_hash(apk_path):
+    stat = os.stat(apk_path)
+    key = (os.path.abspath(apk_path), stat.st_size, stat.st_mtime)
+    if key not in _apk_hashes:
+        sha256 = hashlib.sha256()
+        with open(apk_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                sha256.update(chunk)
+        _apk_hashes[key] = sha256.hexdigest()
+    return _apk_hashes[key]
+
+
+def _installed_apks(serial, packages):
+    # Single shell round trip: version code and hash of every installed APK (base and splits) for each package
+    script = ';'.join(
+        f'echo "@{package} $(dumpsys package {package} | grep -m 1 -o \'versionCode=[0-9]*\')";'
+        f'for f in $(pm path {package} | sed \'s/^package://\'); do sha256sum $f; done'
+        for package in packages)
+    _, output = _run_adb_for(serial, 'shell', script)
+    installed = {}
+    package = None
+    for line in output.split('\n'):
+        line = line.strip()
+        if line.startswith('@'):
+            package = line[1:].split(' ')[0]
+            version_code = re.search(r'versionCode=(\d+)', line)
+            installed[package] = {
+                'version_code': int(version_code.group(1)) if version_code else None,
+                'hashes': set()
+            }
+        elif package is not None and line:
+            installed[package]['hashes'].add(line.split(' ')[0])
+    return installed
+
+
+def _api_level_for(serial):
+    _, output = _run_adb_for(serial, 'shell', 'getprop ro.build.version.sdk')
+    return int(output) if output.isdigit() else 0
+
+
+def _bulk_install_device(serial, apks, hashes, reinstall):
+    results = {}
+    if not reinstall:
+        for package, installed in _installed_apks(serial, apks).items():
+            if installed['hashes'] and installed['hashes'] == hashes[package]:
+                results[package] = {'status': 'skipped', 'version_code': installed['version_code'], 'output': ''}
+    pending = [package for package in apks if package not in results]
+    single_apks = [package for package in pending if len(apks[package]) == 1]
+    if len(single_apks) > 1 and _api_level_for(serial) >= 29:
+        # All single APK packages in one atomic session. If it fails, the loop below installs them one by one
+        # so the result tells which package is the culprit.
+        code, output = _run_adb_for(serial, 'install-multi-package', '-r', *[apks[p][0] for p in single_apks])
+        if code == 0:
+            for package in single_apks:
+                results[package] = {'status': 'installed', 'output': output}
+    for package in pending:
+        if package in results:
+            continue
+        paths = apks[package]
+        if len(paths) == 1:
+            code, output = _run_adb_for(serial, 'install', '-r', paths[0])
+        else:
+            code, output = _run_adb_for(serial, 'install-multiple', '-r', *paths)
+        results[package] = {'status': 'installed' if code == 0 else 'failed', 'output': output}
+    return results
+
+
+def bulk_install(apks, serials=None, reinstall=False, max_workers=None):
+    """
+    Installs several apps on several devices, all devices in parallel.
+    Apps already installed with exactly the same APK files (compared by hash) are skipped.
+    Each APK is hashed once on the host and sent once per device (split APKs in a single install-multiple session).
+    :param apks: Dictionary of app package name to APK path, or to list of APK paths for split APKs.
+    :param serials: Serials of the devices to install on, or None for all connected devices.
+    :param reinstall: If True installs even if the same APK files are already installed.
+    :param max_workers: Maximum number of devices to install on at the same time, or None for all of them.
+    :return: Dictionary of device serial to dictionary of package name to result dictionary, with "status"
+    ("installed", "skipped" or "failed") and "output" (adb output) keys.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    apks = {package: [paths] if isinstance(paths, str) else list(paths) for package, paths in apks.items()}
+    hashes = {package: {_apk_hash(path) for path in paths} for package, paths in apks.items()}
+    if serials is None:
+        serials = devices()
+    if not serials:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(serials)) as executor:
+        results = executor.map(lambda serial: _bulk_install_device(serial, apks, hashes, reinstall), serials)
+        return dict(zip(serials, results))
+
+
+def _bulk_uninstall_device(serial, packages):
+    script = ';'.join(f'echo "@{package} $(pm uninstall {package} 2>&1)"' for package in packages)
+    _, output = _run_adb_for(serial, 'shell', script)
+    results = {package: {'status': 'failed', 'output': output} for package in packages}
+    for line in output.split('\n'):
+        if line.startswith('@'):
+            package, _, package_output = line[1:].partition(' ')
+            package_output = package_output.strip()
+            status = 'uninstalled' if package_output == 'Success' else 'failed'
+            results[package] = {'status': status, 'output': package_output}
+    return results
+
+
+def bulk_uninstall(packages, serials=None, max_workers=None):
+    """
+    Uninstalls several apps on several devices, all devices in parallel.
+    :param packages: List of app package names to uninstall.
+    :param serials: Serials of the devices to uninstall from, or None for all connected devices.
+    :param max_workers: Maximum number of devices to uninstall from at the same time, or None for all of them.
+    :return: Dictionary of device serial to dictionary of package name to result dictionary, with "status"
+    ("uninstalled" or "failed") and "output" (pm output) keys.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    if serials is None:
+        serials = devices()
+    if not serials:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(serials)) as executor:
+        results = executor.map(lambda serial: _bulk_uninstall_device(serial, packages), serials)
+        return dict(zip(serials, results))
 
 
 def long_press_view(view):
@@ -577,7 +912,7 @@ def logcat():
     Returns logcat.
     :return: Full logcat text.
     """
-    return _check_output('adb logcat -d')
+    return _adb_check_output('logcat', '-d')
 
 
 def clear_logcat():
@@ -585,7 +920,7 @@ def clear_logcat():
     Clears logcat.
     :return: Nothing.
     """
-    _run_command(['adb', 'logcat', '-c'])
+    _run_command('logcat', '-c')
 
 
 def screenshot(file_name='../screenshot.png'):
@@ -594,8 +929,10 @@ def screenshot(file_name='../screenshot.png'):
     :param file_name: File name where to store the screenshot.
     :return: Nothing.
     """
-    file = open(file_name, "w")
-    subprocess.Popen(['adb', 'shell', 'screencap', '-p'], stdout=file).wait()
+    png = _run_adb('exec-out', 'screencap', '-p').stdout
+    with open(file_name, 'wb') as file:
+        file.write(png)
+    _notify('screenshot', file_name=file_name)
 
 
 def display_height():
@@ -603,7 +940,7 @@ def display_height():
     Returns device display height.
     :return: Display height in pixels.
     """
-    output = _check_output('adb shell dumpsys window')
+    output = _adb_shell_check_output('dumpsys window')
     return int(re.search(r'displayHeight=(\d+)', output).group(1))
 
 
@@ -616,14 +953,108 @@ def ls(package_name, path):
     :param path: Path inside the app data folder.
     :return: List of file and folder names.
     """
-    _ls = _check_output(f'adb exec-out run-as {package_name} ls -a /data/data/{package_name}/{path}')
-    _ls = _ls.split('\n')
-    _ls = list(map(lambda x: x.split(' '), _ls))
-    result = []
-    for x in _ls:
-        result.extend(x)
-    result = list(filter(lambda x: x and not all(c == '.' for c in x), result))
-    return result
+    _ls = _adb_check_output('exec-out', f'run-as {package_name} ls -a /data/data/{package_name}/{path}')
+    return [name for name in _ls.replace('\n', ' ').split(' ') if name.strip('.')]
+
+
+def _run_as(package_name, script):
+    return _adb_check_output('exec-out', f"run-as {package_name} sh -c '{script}'")
+
+
+def ls_tree(package_name, path='', checksums=False):
+    """
+    Returns all files and folders under the specified app data folder, recursively, with a single adb call.
+    NOTE: This only works for debug APKs.
+    :param package_name: App package name.
+    :param path: Path inside the app data folder, or the data folder itself if empty.
+    :param checksums: If True also computes the MD5 checksum of every file (slower, but catches changes that keep
+    the same size within the same second).
+    :return: Dictionary of path relative to the specified folder to dictionary with "is_dir", "size", "mtime"
+    (seconds since epoch) and, if checksums is True, "md5" (files only).
+    """
+    script = f'cd /data/data/{package_name}/{path} && find . -mindepth 1 -exec stat -c "%f %s %Y %n" {{}} +'
+    if checksums:
+        script += ' && echo @md5 && find . -type f -exec md5sum {} +'
+    tree = {}
+    in_checksums = False
+    for line in _run_as(package_name, script).split('\n'):
+        if not line:
+            continue
+        if line == '@md5':
+            in_checksums = True
+        elif in_checksums:
+            digest, _, name = line.partition('  ')
+            tree[name[2:]]['md5'] = digest
+        else:
+            mode, size, mtime, name = line.split(' ', 3)
+            tree[name[2:]] = {
+                'is_dir': int(mode, 16) & 0o170000 == 0o040000,
+                'size': int(size),
+                'mtime': int(mtime)
+            }
+    return tree
+
+
+def diff_tree(old_tree, new_tree):
+    """
+    Compares two app data folder listings, e.g. taken between test steps.
+    :param old_tree: Listing as returned by ls_tree().
+    :param new_tree: Listing as returned by ls_tree().
+    :return: Dictionary with "added", "removed" and "modified" keys, each a sorted list of paths.
+    Folders are only reported as added or removed, never as modified.
+    """
+    modified = []
+    for name in old_tree.keys() & new_tree.keys():
+        old = old_tree[name]
+        new = new_tree[name]
+        if new['is_dir']:
+            continue
+        if old['size'] != new['size'] or old['mtime'] != new['mtime'] or old.get('md5') != new.get('md5'):
+            modified.append(name)
+    return {
+        'added': sorted(new_tree.keys() - old_tree.keys()),
+        'removed': sorted(old_tree.keys() - new_tree.keys()),
+        'modified': sorted(modified)
+    }
+
+
+def pull_tree(package_name, path, destination):
+    """
+    Copies a whole app data folder to the host, streamed as a single tar archive.
+    NOTE: This only works for debug APKs.
+    This will throw a CalledProcessError if the folder can't be read (e.g. not a debug APK).
+    :param package_name: App package name.
+    :param path: Path inside the app data folder, or the data folder itself if empty.
+    :param destination: Host folder where to extract it. Paths are kept relative to the app data folder.
+    Links pointing outside of it (like the "lib" link to the app native libraries every data folder has) and
+    other unsafe members are not extracted.
+    :return: List of extracted paths.
+    """
+    import tarfile
+    command = _adb('exec-out', f'run-as {package_name} tar -cf - -C /data/data/{package_name} {path or "."}')
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    names = []
+    readable = True
+    try:
+        with tarfile.open(fileobj=process.stdout, mode='r|') as tar:
+            for member in tar:
+                # The archive comes from the app under test, don't follow links or write outside destination
+                try:
+                    tar.extract(member, destination, filter='data')
+                except tarfile.FilterError:
+                    continue
+                names.append(member.name)
+    except tarfile.ReadError:
+        # run-as errors (e.g. app not debuggable) come instead of the archive
+        readable = False
+    finally:
+        process.stdout.close()
+        stderr = process.stderr.read()
+        process.stderr.close()
+        returncode = process.wait()
+    if not readable or returncode != 0:
+        raise subprocess.CalledProcessError(returncode or 1, command, stderr=stderr)
+    return names
 
 
 def wait_for_view_with_text(_text, timeout=5):
@@ -644,7 +1075,7 @@ def api_level():
     Returns device API level (aka Android version)
     :return: API level as integer.
     """
-    return int(_check_output('adb shell getprop ro.build.version.sdk'))
+    return int(_adb_shell_check_output('getprop ro.build.version.sdk'))
 
 def airplane_mode(is_enabled = None):
     """
@@ -652,7 +1083,7 @@ def airplane_mode(is_enabled = None):
     :param is_enabled: True for Airplane mode on, False for Airplane mode off, None for switching
     """
     if is_enabled is None:
-        output = _check_output('adb shell cmd connectivity airplane-mode')
+        output = _adb_shell_check_output('cmd connectivity airplane-mode')
         if output == 'enabled':
             is_enabled = False
         else:
@@ -661,7 +1092,7 @@ def airplane_mode(is_enabled = None):
         param = 'enable'
     else:
         param = 'disable'
-    _run_command(['adb', 'shell', 'cmd', 'connectivity', 'airplane-mode', param])
+    _run_adb_shell(f'cmd connectivity airplane-mode {param}')
 
 def launch_deeplink(url, expected_activity = None, timeout = 5):
     """
@@ -0,0 +1,291 @@
+import asyncio
+import re
+
+from pytomation import android
+
+
+def _adb(serial):
+    if serial is None:
+        return ['adb']
+    return ['adb', '-s', serial]
+
+
+async def _run(serial, *args, assertion=True):
+    process = await asyncio.create_subprocess_exec(
+        *_adb(serial), *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    stdout, _ = await process.communicate()
+    if assertion:
+        assert process.returncode == 0
+    return stdout
+
+
+async def _run_adb_shell(command, serial=None, assertion=True):
+    await _run(serial, 'shell', command, assertion=assertion)
+    await asyncio.sleep(0.3)
+
+
+async def _adb_shell_check_output(command, serial=None):
+    return (await _run(serial, 'shell', command)).decode(errors='replace').strip()
+
+
+async def view_hierarchy(serial=None):
+    """
+    Returns current screen view hierarchy.
+    :param serial: Device serial, or None for the only connected device.
+    :return: Dictionary representing the current screen view hierarchy.
+    """
+    import xmltodict
+    xml = await _adb_shell_check_output('uiautomator dump > /dev/null && cat /sdcard/window_dump.xml', serial)
+    return xmltodict.parse(xml)
+
+
+async def find_view_by_id(res_id, view=None, serial=None):
+    """
+    Returns first view (as dictionary) which id contains res_id in current screen.
+    :param res_id: Resource id to look for.
+    :param view: View hierarchy dictionary to look under, or None to get current screen view hierarchy.
+    :param serial: Device serial, or None for the only connected device.
+    :return: View as a dictionary if found, None otherwise.
+    """
+    if view is None:
+        view = await view_hierarchy(serial)
+    return android.find_view_by_id(res_id, view)
+
+
+async def find_view_by_content_desc(content_desc, view=None, serial=None):
+    """
+    Returns first view (as dictionary) by content description.
+    :param content_desc: Content description to look for.
+    :param view: View hierarchy dictionary to look under, or None to get current screen view hierarchy.
+    :param serial: Device serial, or None for the only connected device.
+    :return: View as a dictionary if found, None otherwise.
+    """
+    if view is None:
+        view = await view_hierarchy(serial)
+    return android.find_view_by_content_desc(content_desc, view)
+
+
+async def find_view_by_text(_text, view=None, serial=None):
+    """
+    Returns first view (as dictionary) by contained text.
+    :param _text: View text to look for.
+    :param view: View hierarchy dictionary to look under, or None to get current screen view hierarchy.
+    :param serial: Device serial, or None for the only connected device.
+    :return: View as a dictionary if found, None otherwise.
+    """
+    if view is None:
+        view = await view_hierarchy(serial)
+    return android.find_view_by_text(_text, view)
+
+
+async def tap(x, y, serial=None):
+    """
+    Taps by coordinates.
+    :param x: X coordinate to tap.
+    :param y: Y coordinate to tap.
+    :param serial: Device serial, or None for the only connected device.
+    :return: Nothing.
+    """
+    await _run_adb_shell(f'input tap {x} {y}', serial)
+
+
+async def tap_view(view, serial=None):
+    """
+    Taps a view.
+    :param view: The view to tap.
+    :param serial: Device serial, or None for the only connected device.
+    :return: True if view coordinates found, False otherwise.
+    """
+    click_coord = android._tap_coordinates_for_view(view)
+    if click_coord is None:
+        return False
+    await tap(click_coord[0], click_coord[1], serial)
+    return True
+
+
+async def tap_view_by_id(res_id, view=None, serial=None):
+    """
+    Taps first view by id.
+    :param res_id: Resource id to look for.
+    :param view: View hierarchy dictionary to look under, or None to get current screen view hierarchy.
+    :param serial: Device serial, or None for the only connected device.
+    :return: True if view found, False otherwise.
+    """
+    return await tap_view(await find_view_by_id(res_id, view, serial), serial)
+
+
+async def tap_view_by_text(_text, view=None, serial=None):
+    """
+    Taps first view by text.
+    :param _text: Text to look for.
+    :param view: View hierarchy dictionary to look under, or None to get current screen view hierarchy.
+    :param serial: Device serial, or None for the only connected device.
+    :return: True if view found, False otherwise.
+    """
+    return await tap_view(await find_view_by_text(_text, view, serial), serial)
+
+
+async def tap_view_by_content_description(content_description, view=None, serial=None):
+    """
+    Taps first view by content description.
+    :param content_description: Content description to look for.
+    :param view: View hierarchy dictionary to look under, or None to get current screen view hierarchy.
+    :param serial: Device serial, or None for the only connected device.
+    :return: True if view found, False otherwise.
+    """
+    return await tap_view(await find_view_by_content_desc(content_description, view, serial), serial)
+
+
+async def current_activity_name(serial=None):
+    """
+    Returns foreground activity (not canonical) class name.
+    :param serial: Device serial, or None for the only connected device.
+    :return: Activity class name, or None if there is no foreground activity.
+    """
+    output = await _adb_shell_check_output(
+        "dumpsys activity activities | grep -E 'mResumedActivity|topResumedActivity' || true", serial)
+    match = re.search(r'u\d+ [\w.]+/([\w.$]+)', output)
+    if match is None:
+        return None
+    return android._activity_class_name(match.group(1))
+
+
+async def _wait_for(condition, timeout, interval):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while True:
+        if await condition():
+            return True
+        if loop.time() + interval > deadline:
+            return False
+        await asyncio.sleep(interval)
+
+
+async def wait_for_activity(activity, timeout=5, interval=1, serial=None):
+    """
+    Waits for an activity by class name to become the foreground activity.
+    :param activity: Class name of the activity.
+    :param timeout: Timeout in seconds.
+    :param interval: Seconds between checks.
+    :param serial: Device serial, or None for the only connected device.
+    :return: True if the activity became the foreground activity before the timeout, False otherwise.
+    """
+    async def condition():
+        return activity in (await current_activity_name(serial) or '')
+    return await _wait_for(condition, timeout, interval)
+
+
+async def wait_for_res(res_id, timeout=5, interval=1, serial=None):
+    """
+    Waits for view by id to appear.
+    :param res_id: Resource id of the view.
+    :param timeout: Timeout in seconds.
+    :param interval: Seconds between checks.
+    :param serial: Device serial, or None for the only connected device.
+    :return: True if the view was found before the timeout, False otherwise.
+    """
+    async def condition():
+        return await find_view_by_id(res_id, serial=serial) is not None
+    return await _wait_for(condition, timeout, interval)
+
+
+async def wait_for_text(res_id, _text, timeout=5, interval=1, serial=None):
+    """
+    Waits for text in specified view to appear.
+    :param res_id: Resource id of the view.
+    :param _text: Text to look for in the view.
+    :param timeout: Timeout in seconds.
+    :param interval: Seconds between checks.
+    :param serial: Device serial, or None for the only connected device.
+    :return: True if the text was found before the timeout, False otherwise.
+    """
+    async def condition():
+        node = await find_view_by_id(res_id, serial=serial)
+        return node is not None and _text in node.get('@text', '')
+    return await _wait_for(condition, timeout, interval)
+
+
+async def wait_for_view_with_text(_text, timeout=5, interval=1, serial=None):
+    """
+    Waits for a view with the specific text to appear.
+    :param _text: Text in the view.
+    :param timeout: Timeout in seconds.
+    :param interval: Seconds between checks.
+    :param serial: Device serial, or None for the only connected device.
+    :return: True if the view appeared before the timeout, False otherwise.
+    """
+    async def condition():
+        return await find_view_by_text(_text, serial=serial) is not None
+    return await _wait_for(condition, timeout, interval)
+
+
+async def screenshot(file_name='../screenshot.png', serial=None):
+    """
+    Saves a screenshot in the host (not in the device itself).
+    :param file_name: File name where to store the screenshot.
+    :param serial: Device serial, or None for the only connected device.
+    :return: Nothing.
+    """
+    png = await _run(serial, 'exec-out', 'screencap -p')
+    with open(file_name, 'wb') as file:
+        file.write(png)
+
+
+async def logcat(serial=None):
+    """
+    Returns logcat.
+    :param serial: Device serial, or None for the only connected device.
+    :return: Full logcat text.
+    """
+    return (await _run(serial, 'logcat', '-d')).decode(errors='replace').strip()
+
+
+async def stream_logcat(serial=None):
+    """
+    Streams logcat lines as they are written, starting from now. Stops when the caller stops iterating.
+    :param serial: Device serial, or None for the only connected device.
+    :return: Asynchronous iterator of logcat lines.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *_adb(serial), 'logcat', '-T', '1', stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    try:
+        async for line in process.stdout:
+            yield line.decode(errors='replace').rstrip()
+    finally:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+
+
+async def clear_logcat(serial=None):
+    """
+    Clears logcat.
+    :param serial: Device serial, or None for the only connected device.
+    :return: Nothing.
+    """
+    await _run(serial, 'logcat', '-c')
+
+
+async def launch(app_package, activity_name=None, serial=None):
+    """
+    Launches the specified app.
+    :param app_package: App package name to launch.
+    :param activity_name: Activity name to launch, or main activity as defined in manifest if None.
+    :param serial: Device serial, or None for the only connected device.
+    :return: Nothing.
+    """
+    if activity_name is None:
+        await _run_adb_shell(f'monkey -p {app_package} -c android.intent.category.LAUNCHER 1', serial)
+    else:
+        await _run_adb_shell(f'am start {app_package}/{activity_name}', serial)
+    await asyncio.sleep(0.5)
+
+
+async def stop(app_package, serial=None):
+    """
+    Stops app.
+    :param app_package: App package name to stop.
+    :param serial: Device serial, or None for the only connected device.
+    :return: Nothing.
+    """
+    await _run_adb_shell(f'am force-stop {app_package}', serial)
@@ -0,0 +1,41 @@
+"""
+Measures how long importing each module takes, in a fresh interpreter each time.
+Expects this repository to be checked out as a folder named "pytomation".
+Usage: python benchmarks/import_time.py [runs]
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+MODULES = ['android', 'android_async', 'device_manager', 'pytesseract_helper', 'charles', 'timeline', 'image_locator']
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _import_time(statement, runs):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(ROOT))
+    times = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', f'import time; t = time.perf_counter(); {statement}; '
+                                   f'print(time.perf_counter() - t)'],
+            capture_output=True, text=True, env=env)
+        if output.returncode != 0:
+            return None, output.stderr.strip().split('\n')[-1]
+        times.append(float(output.stdout))
+    return statistics.median(times), None
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    for module in MODULES:
+        seconds, error = _import_time(f'import pytomation.{module}', runs)
+        if error is None:
+            print(f'{module:20} {seconds * 1000:8.2f} ms')
+        else:
+            print(f'{module:20} failed: {error}')
+
+
+if __name__ == '__main__':
+    main()
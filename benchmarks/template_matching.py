@@ -0,0 +1,87 @@
+"""
+Checks that find_template() finds templates cropped out of synthetic screenshots at their own position, and
+measures how long it takes. Only crops without any close match elsewhere in the screenshot are used.
+Expects this repository to be checked out as a folder named "pytomation".
+Usage: python benchmarks/template_matching.py [screenshots] [templates per screenshot]
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+from pytomation import image_locator
+
+WIDTH = 1080
+HEIGHT = 1920
+TEMPLATE_SIZE = 64
+
+
+def _random_color(rng):
+    return tuple(rng.randrange(256) for _ in range(3))
+
+
+def _screenshot(rng):
+    image = Image.new('RGB', (WIDTH, HEIGHT), _random_color(rng))
+    draw = ImageDraw.Draw(image)
+    for _ in range(60):
+        x = rng.randrange(WIDTH)
+        y = rng.randrange(HEIGHT)
+        box = (x, y, x + rng.randrange(20, 400), y + rng.randrange(20, 200))
+        if rng.random() < 0.5:
+            draw.rectangle(box, fill=_random_color(rng))
+        else:
+            draw.ellipse(box, fill=_random_color(rng))
+    for _ in range(80):
+        words = ' '.join(rng.choice(['Settings', 'OK', 'Cancel', 'Login', 'Profile', 'Search', 'Home', '42'])
+                         for _ in range(rng.randrange(1, 4)))
+        draw.text((rng.randrange(WIDTH - 100), rng.randrange(HEIGHT - 20)), words, fill=_random_color(rng))
+    return image
+
+
+# Crop with no close match in the rest of the screenshot, as found by a full resolution search
+def _unique_crop(rng, image, gray):
+    while True:
+        x = rng.randrange(WIDTH - TEMPLATE_SIZE)
+        y = rng.randrange(HEIGHT - TEMPLATE_SIZE)
+        template = image.crop((x, y, x + TEMPLATE_SIZE, y + TEMPLATE_SIZE))
+        scores = image_locator._match(gray, image_locator._to_gray(template))
+        if scores[y, x] < 0.999:
+            continue
+        scores[max(y - 2, 0):y + 3, max(x - 2, 0):x + 3] = -1
+        if scores.max() < 0.95:
+            return x, y, template
+
+
+def main():
+    screenshots = int(sys.argv[1]) if len(sys.argv) > 1 else 6
+    templates = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    rng = random.Random(0)
+    misses = 0
+    seconds = 0
+    with tempfile.TemporaryDirectory() as directory:
+        screenshot_path = os.path.join(directory, 'screenshot.png')
+        for _ in range(screenshots):
+            image = _screenshot(rng)
+            image.save(screenshot_path)
+            gray = image_locator._to_gray(image)
+            for _ in range(templates):
+                x, y, template = _unique_crop(rng, image, gray)
+                start = time.perf_counter()
+                found = image_locator.find_template(template, screenshot_path)
+                seconds += time.perf_counter() - start
+                if found is None or found['bounds'][0] != (x, y):
+                    misses += 1
+                    print(f'Template at {(x, y)} found at {found and found["bounds"][0]} '
+                          f'(score {found and round(found["score"], 3)})')
+    total = screenshots * templates
+    print(f'{total - misses}/{total} found at their position, {seconds / total * 1000:.1f} ms per search')
+    sys.exit(1 if misses else 0)
+
+
+if __name__ == '__main__':
+    main()
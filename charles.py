@@ -1,9 +1,14 @@
+import base64
+import gzip
+import marshal
 import os
 import re
 import subprocess
+import threading
 import time
+from collections.abc import Mapping
+from urllib.parse import quote_plus
 
-import requests
 import json
 
 MAIN_URL = 'http://control.charles'
@@ -14,6 +19,7 @@ DISABLE_LOCAL_MAPPING_URL = 'http://control.charles/tools/map-local/disable'
 ENABLE_THROTTLING_URL = 'http://control.charles/throttling/activate?preset='
 DISABLE_THROTTLING_URL = 'http://control.charles/throttling/deactivate?'
 DISABLE_REWRITE_URL = 'http://control.charles/tools/rewrite/disable'
+TOOL_URL = 'http://control.charles/tools/{}/{}'
 
 CHARLES_APP_PATH = '/Applications/Charles.app/Contents/MacOS/Charles'
 
@@ -26,6 +32,29 @@ throttling_presets = {
     '256': 'http://control.charles/throttling/activate?preset=256+kbps+ISDN%2FDSL',
 }
 
+# Network profiles for apply_network_profile(). Settings not in a profile are left as they are.
+# "throttling" is the name of a throttling preset as configured in Charles (Charles control interface can't set
+# bandwidth or latency directly), True to activate the last used one or None to deactivate throttling.
+# Any other key is a Charles tool (as in its control interface URL) to enable (True) or disable (False).
+network_profiles = {
+    'clean': {
+        'throttling': None,
+        'map-local': False,
+        'map-remote': False,
+        'rewrite': False,
+        'no-caching': False,
+        'block-cookies': False
+    },
+    'no-throttling': {'throttling': None},
+    '256': {'throttling': '256 kbps ISDN/DSL'},
+    '512': {'throttling': '512 kbps ISDN/DSL'},
+    '3G': {'throttling': '3G'},
+    '4G': {'throttling': '4G'},
+}
+
+# Setting name to last control URL successfully called for it, so no-op calls can be skipped
+_charles_state = {}
+
 
 def launch(path=CHARLES_APP_PATH, config=None):
     """
@@ -52,21 +81,40 @@ def launch(path=CHARLES_APP_PATH, config=None):
 
 
 def _get_url(url):
+    import requests
     response = requests.get(url, proxies=proxies)
     return response.content
 
 
 def _call_url(url):
+    import requests
     response = requests.get(url, proxies=proxies)
     assert response.status_code == 200
 
 
+def _call_setting(name, url):
+    _call_url(url)
+    _charles_state[name] = url
+
+
+def _setting_url(name, value):
+    if name == 'throttling':
+        if not value:
+            return DISABLE_THROTTLING_URL
+        if value is True:
+            return ENABLE_THROTTLING_URL
+        return ENABLE_THROTTLING_URL + quote_plus(value)
+    return TOOL_URL.format(name, 'enable' if value else 'disable')
+
+
 def clear_session():
     """
     Clears current session
     :return: Nothing.
     """
     _call_url(CLEAR_SESSION_URL)
+    with _matchers_changed:
+        _session_tracker['seen'] = 0
 
 
 def _get_session_json():
@@ -81,12 +129,167 @@ def get_session():
     return json.loads(_get_session_json())
 
 
+class SessionEntry(Mapping):
+    """
+    Compact Charles session entry.
+    Keeps request and response headers serialized and only decodes them when needed: the rest of the entry is
+    available right away, headers and bodies are decoded (including base64 and gzip) on first access and memoized.
+    Can also be used as the (read only) session entry dictionary, e.g. entry['request']['header'].
+    """
+    __slots__ = ('method', 'host', 'path', 'status', '_packed_headers', '_data', '_decoded')
+
+    def __init__(self, data):
+        self.method = data.get('method')
+        self.host = data.get('host')
+        self.path = data.get('path')
+        self.status = data.get('status')
+        # Headers are most of the small objects of an entry, marshal keeps them compact and is quick to undo
+        headers = {}
+        for message in ('request', 'response'):
+            if isinstance(data.get(message), dict) and 'header' in data[message]:
+                headers[message] = data[message]['header']
+                data[message]['header'] = None
+        self._packed_headers = marshal.dumps(headers) if headers else None
+        self._data = data
+        self._decoded = None
+
+    def __getitem__(self, key):
+        if key not in ('request', 'response'):
+            return self._data[key]
+        return self.data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f'SessionEntry({self.method} {self.host}{self.path} {self.status})'
+
+    @property
+    def data(self):
+        """
+        Full session entry as a dictionary.
+        """
+        if self._packed_headers is not None:
+            for message, header in marshal.loads(self._packed_headers).items():
+                self._data[message]['header'] = header
+            self._packed_headers = None
+        return self._data
+
+    def _memoized(self, key, decode):
+        if self._decoded is None:
+            self._decoded = {}
+        if key not in self._decoded:
+            self._decoded[key] = decode()
+        return self._decoded[key]
+
+    def _headers(self, message):
+        headers = ((self.data.get(message) or {}).get('header') or {}).get('headers') or []
+        return {header['name'].lower(): header['value'] for header in headers}
+
+    def _body_dict(self, message):
+        return (self.data.get(message) or {}).get('body') or {}
+
+    def _body(self, message):
+        body = self._body_dict(message)
+        if 'text' in body:
+            return body['text'].encode(body.get('charset') or 'utf-8')
+        if 'encoded' not in body:
+            return None
+        content = base64.b64decode(body['encoded'])
+        if content[:2] == b'\x1f\x8b':
+            content = gzip.decompress(content)
+        return content
+
+    def _text(self, message):
+        body = self._body_dict(message)
+        if 'text' in body:
+            return body['text']
+        content = self._body(message)
+        if content is None:
+            return None
+        return content.decode(body.get('charset') or 'utf-8', errors='replace')
+
+    @property
+    def request_headers(self):
+        """
+        Request headers as a dictionary, with lower case header names.
+        """
+        return self._memoized('request_headers', lambda: self._headers('request'))
+
+    @property
+    def response_headers(self):
+        """
+        Response headers as a dictionary, with lower case header names.
+        """
+        return self._memoized('response_headers', lambda: self._headers('response'))
+
+    @property
+    def request_body(self):
+        """
+        Request body as bytes (base64 and gzip decoded), or None if there is no body.
+        """
+        return self._memoized('request_body', lambda: self._body('request'))
+
+    @property
+    def response_body(self):
+        """
+        Response body as bytes (base64 and gzip decoded), or None if there is no body.
+        """
+        return self._memoized('response_body', lambda: self._body('response'))
+
+    @property
+    def request_text(self):
+        """
+        Request body as text, or None if there is no body.
+        """
+        return self._memoized('request_text', lambda: self._text('request'))
+
+    @property
+    def response_text(self):
+        """
+        Response body as text, or None if there is no body.
+        """
+        return self._memoized('response_text', lambda: self._text('response'))
+
+    @property
+    def request_json(self):
+        """
+        Request body parsed as JSON.
+        """
+        return self._memoized('request_json', lambda: json.loads(self.request_text))
+
+    @property
+    def response_json(self):
+        """
+        Response body parsed as JSON.
+        """
+        return self._memoized('response_json', lambda: json.loads(self.response_text))
+
+
+def _session_entries(session_json):
+    return [SessionEntry(data) for data in json.loads(session_json)]
+
+
+def get_session_entries():
+    """
+    Returns current session as a list of SessionEntry.
+    Much lighter than get_session() for big sessions, since headers and bodies are only decoded when accessed.
+    :return: Current Charles session as a list of SessionEntry.
+    """
+    return _session_entries(_get_session_json())
+
+
 def get_request_body(session_entry):
     """
     Returns request body of a session entry.
-    :param session_entry: Charles session entry.
+    :param session_entry: Charles session entry (dictionary or SessionEntry).
     :return: Body request of the session entry.
     """
+    if isinstance(session_entry, SessionEntry):
+        return session_entry.request_json
     return json.loads(session_entry['request']['body']['text'])
 
 
@@ -95,7 +298,7 @@ def enable_local_mapping():
     Turns on local mapping as defined by the loaded configuration.
     :return: Nothing.
     """
-    _call_url(ENABLE_LOCAL_MAPPING_URL)
+    _call_setting('map-local', ENABLE_LOCAL_MAPPING_URL)
 
 
 def disable_local_mapping():
@@ -103,7 +306,7 @@ def disable_local_mapping():
     Disables local mapping.
     :return: Nothing.
     """
-    _call_url(DISABLE_LOCAL_MAPPING_URL)
+    _call_setting('map-local', DISABLE_LOCAL_MAPPING_URL)
 
 
 def kill():
@@ -112,6 +315,7 @@ def kill():
     :return: Nothing.
     """
     os.system('killall -9 Charles')
+    _charles_state.clear()
 
 
 def get_first_entry(session, path, assertion=True):
@@ -136,10 +340,11 @@ def get_first_entry_in_session(path, desc=False, assertion=True):
     :param assertion: If True will assert an entry was found.
     :return: Session entry with the specified path.
     """
-    session = get_session()
+    session = get_session_entries()
     if desc:
         session.reverse()
-    return get_first_entry(session, path, assertion)
+    entry = get_first_entry(session, path, assertion)
+    return entry.data if entry is not None else None
 
 
 def check_no_request(path):
@@ -148,7 +353,7 @@ def check_no_request(path):
     :param path: Path to look for.
     :return: Nothing.
     """
-    for entry in get_session():
+    for entry in get_session_entries():
         if entry is not None:
             assert path not in entry['path']
 
@@ -182,7 +387,7 @@ def disable_throttling():
     Disables throttling.
     :return: Nothing.
     """
-    _call_url(DISABLE_THROTTLING_URL)
+    _call_setting('throttling', DISABLE_THROTTLING_URL)
 
 
 def disable_rewrite():
@@ -190,7 +395,7 @@ def disable_rewrite():
     Disables all configured rewrites.
     :return: Nothing.
     """
-    _call_url(DISABLE_REWRITE_URL)
+    _call_setting('rewrite', DISABLE_REWRITE_URL)
 
 
 def check_no_request_host(host):
@@ -199,7 +404,7 @@ def check_no_request_host(host):
     :param host: Host to check.
     :return: True if no requests have been made to the specified host, False otherwise.
     """
-    return all(entry for entry in get_session() if entry and entry['host'] != host)
+    return all(entry for entry in get_session_entries() if entry and entry['host'] != host)
 
 
 def enable_throttling(preset=None):
@@ -209,7 +414,227 @@ def enable_throttling(preset=None):
     :return: Nothing.
     """
     if preset:
-        _call_url(throttling_presets[preset])
+        _call_setting('throttling', throttling_presets[preset])
     else:
-        _call_url(ENABLE_THROTTLING_URL)
+        _call_setting('throttling', ENABLE_THROTTLING_URL)
+
+
+# Request matchers, evaluated against each new session entry once
+_matchers = []
+_matchers_changed = threading.Condition()
+_session_tracker = {
+    'seen': 0,
+    'thread': None,
+    'stop': None,
+    'error': None
+}
+
+
+def _entry_matches(entry, matcher):
+    return entry is not None and \
+        (matcher['method'] is None or entry['method'].upper() == matcher['method'].upper()) and \
+        (matcher['host'] is None or entry['host'] == matcher['host']) and \
+        (matcher['path'] is None or entry['path'] == matcher['path'])
+
+
+def _poll_session():
+    session = get_session_entries()
+    with _matchers_changed:
+        seen = _session_tracker['seen']
+        if len(session) < seen:
+            # Session was cleared outside of clear_session()
+            seen = 0
+        for entry in session[seen:]:
+            for matcher in _matchers:
+                if matcher['entry'] is None and _entry_matches(entry, matcher):
+                    matcher['entry'] = entry
+        _session_tracker['seen'] = len(session)
+        _matchers_changed.notify_all()
+
+
+def _tracking():
+    thread = _session_tracker['thread']
+    return thread is not None and thread.is_alive()
+
+
+def _raise_tracker_error():
+    if _session_tracker['error'] is not None:
+        raise _session_tracker['error']
+
+
+def _track_session(stop, interval):
+    try:
+        import requests
+        while not stop.wait(interval):
+            try:
+                _poll_session()
+            except requests.RequestException:
+                # Charles might be restarting, try again next time
+                pass
+    except Exception as e:
+        # Kept to be raised by waits and checks, otherwise they would only fail at their deadline
+        with _matchers_changed:
+            _session_tracker['error'] = e
+            _matchers_changed.notify_all()
+
+
+def start_tracking(interval=0.5):
+    """
+    Starts polling the current session in the background, evaluating request matchers on every new entry.
+    Entries already in the session are ignored.
+    :param interval: Seconds between session polls.
+    :return: Nothing.
+    """
+    if _tracking():
+        return
+    with _matchers_changed:
+        _session_tracker['seen'] = len(get_session_entries())
+        _session_tracker['error'] = None
+    stop = threading.Event()
+    thread = threading.Thread(target=_track_session, args=(stop, interval), daemon=True)
+    thread.start()
+    _session_tracker['stop'] = stop
+    _session_tracker['thread'] = thread
+
+
+def stop_tracking():
+    """
+    Stops polling the current session.
+    :return: Nothing.
+    """
+    if _session_tracker['thread'] is None:
+        return
+    _session_tracker['stop'].set()
+    _session_tracker['thread'].join()
+    _session_tracker['stop'] = None
+    _session_tracker['thread'] = None
+    _session_tracker['error'] = None
+
+
+def _add_matcher(kind, path, host, method, timeout):
+    matcher = {
+        'kind': kind,
+        'path': path,
+        'host': host,
+        'method': method,
+        'deadline': None if timeout is None else time.time() + timeout,
+        'entry': None
+    }
+    with _matchers_changed:
+        _matchers.append(matcher)
+    return matcher
+
+
+def expect_request(path=None, host=None, method=None, timeout=5):
+    """
+    Registers a request expected to be made within the timeout, e.g. expect_request('/v1/events', method='POST').
+    Only session entries not seen yet by the tracker are evaluated (see start_tracking()).
+    :param path: Path of the request, or None for any path.
+    :param host: Host of the request, or None for any host.
+    :param method: HTTP method of the request, or None for any method.
+    :param timeout: Seconds from now the request is expected within.
+    :return: Matcher, to be used with wait_for_request().
+    """
+    assert timeout is not None
+    return _add_matcher('expect', path, host, method, timeout)
+
 
+def forbid_request(path=None, host=None, method=None):
+    """
+    Registers a forbidden request, e.g. forbid_request(host='ads.example.com').
+    Once such a request is seen, wait_for_request() and check_requests() fail immediately.
+    :param path: Path of the request, or None for any path.
+    :param host: Host of the request, or None for any host.
+    :param method: HTTP method of the request, or None for any method.
+    :return: Matcher.
+    """
+    return _add_matcher('forbid', path, host, method, None)
+
+
+def _assert_no_forbidden_requests():
+    for matcher in _matchers:
+        if matcher['kind'] == 'forbid':
+            entry = matcher['entry']
+            assert entry is None, f"Forbidden request: {entry['method']} {entry['host']}{entry['path']}"
+
+
+def wait_for_request(matcher, interval=0.5):
+    """
+    Waits for the request of an expect_request() matcher, returning as soon as it's seen.
+    If the tracker is not running, the session is polled with the specified interval.
+    This will throw an assertion error if the request is not seen before the timeout or a forbidden request is seen,
+    and the error that stopped the tracker if it stopped unexpectedly.
+    :param matcher: Matcher returned by expect_request().
+    :param interval: Seconds between session polls if the tracker is not running.
+    :return: Session entry of the request.
+    """
+    assert matcher['kind'] == 'expect'
+    while True:
+        _raise_tracker_error()
+        if not _tracking():
+            _poll_session()
+        with _matchers_changed:
+            _raise_tracker_error()
+            _assert_no_forbidden_requests()
+            if matcher['entry'] is not None:
+                return matcher['entry']
+            remaining = matcher['deadline'] - time.time()
+            assert remaining > 0, f"Expected request not made: {matcher['method']} {matcher['host']} {matcher['path']}"
+            if _tracking():
+                _matchers_changed.wait(remaining)
+                continue
+        time.sleep(min(interval, remaining))
+
+
+def check_requests():
+    """
+    Checks all registered matchers: no forbidden request was made and expected requests past their timeout were made.
+    This will throw an assertion error otherwise, and the error that stopped the tracker if it stopped unexpectedly.
+    :return: Nothing.
+    """
+    _raise_tracker_error()
+    if not _tracking():
+        _poll_session()
+    with _matchers_changed:
+        _assert_no_forbidden_requests()
+        now = time.time()
+        for matcher in _matchers:
+            if matcher['kind'] == 'expect' and matcher['deadline'] < now:
+                assert matcher['entry'] is not None, \
+                    f"Expected request not made: {matcher['method']} {matcher['host']} {matcher['path']}"
+
+
+def clear_matchers():
+    """
+    Removes all registered request matchers.
+    :return: Nothing.
+    """
+    with _matchers_changed:
+        _matchers.clear()
+
+
+def apply_network_profile(profile):
+    """
+    Applies a network profile: throttling preset and Charles tools enabled or disabled.
+    Only settings that differ from the state known to be set are changed, all of them concurrently.
+    :param profile: Name of a profile in network_profiles, or profile dictionary (see network_profiles).
+    :return: Dictionary of the settings that were changed.
+    """
+    if isinstance(profile, str):
+        profile = network_profiles[profile]
+    changes = {name: _setting_url(name, value) for name, value in profile.items()}
+    changes = {name: url for name, url in changes.items() if _charles_state.get(name) != url}
+    if changes:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(max_workers=len(changes)) as executor:
+            list(executor.map(lambda name: _call_setting(name, changes[name]), changes))
+    return {name: profile[name] for name in changes}
+
+
+def forget_network_state():
+    """
+    Forgets the Charles settings state known by apply_network_profile(), e.g. after changing settings in Charles UI.
+    Next profile applied will set all its settings.
+    :return: Nothing.
+    """
+    _charles_state.clear()
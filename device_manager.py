@@ -0,0 +1,360 @@
+import queue
+import re
+import shlex
+import subprocess
+import threading
+import time
+import uuid
+
+from pytomation import android
+
+# Managed devices by serial. Each one keeps a warm "adb shell" connection, its state as seen by "adb devices"
+# and reconnection statistics.
+_devices = {}
+_devices_lock = threading.Lock()
+
+# adb errors meaning the command never reached the device, so it is safe to run it again once the device is back
+_unreachable_pattern = re.compile(r"device (?:'.*' )?not found|device offline|no devices/emulators found|error: closed")
+
+_watchdog = {
+    'thread': None,
+    'stop': None
+}
+
+
+class _CommandNotSent(ConnectionError):
+    # The connection was already broken when writing the command, so the device never got it
+    pass
+
+
+def _read_shell(process, lines):
+    for line in process.stdout:
+        lines.put(line)
+    lines.put(None)
+
+
+def _open_shell(device):
+    process = subprocess.Popen(['adb', '-s', device['serial'], 'shell'], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, errors='replace')
+    lines = queue.Queue()
+    threading.Thread(target=_read_shell, args=(process, lines), daemon=True).start()
+    device['shell'] = process
+    device['lines'] = lines
+
+
+def _close_shell(device):
+    process = device['shell']
+    if process is not None:
+        process.kill()
+        process.wait()
+    device['shell'] = None
+    device['lines'] = None
+
+
+def _mark_down(device):
+    if device['down_since'] is None:
+        device['down_since'] = time.monotonic()
+
+
+def _mark_up(device):
+    if device['down_since'] is not None:
+        device['downtime'] += time.monotonic() - device['down_since']
+        device['down_since'] = None
+
+
+def _shell_run(device, command, timeout):
+    if device['shell'] is None or device['shell'].poll() is not None:
+        _open_shell(device)
+    marker = f'__pytomation_{uuid.uuid4().hex}__'
+    # Run in a subshell so a syntax error doesn't end the kept open shell, and without stdin so the command can't
+    # consume the next commands.
+    try:
+        device['shell'].stdin.write(f'sh -c {shlex.quote(command)} < /dev/null; echo "{marker} $?"\n')
+        device['shell'].stdin.flush()
+    except OSError as e:
+        raise _CommandNotSent(f'Shell connection closed on {device["serial"]}') from e
+    output = []
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            line = device['lines'].get(timeout=max(deadline - time.monotonic(), 0))
+        except queue.Empty:
+            raise TimeoutError(f'Shell command timed out on {device["serial"]}: {command}')
+        if line is None:
+            raise ConnectionError(f'Shell connection closed on {device["serial"]}')
+        index = line.find(marker)
+        if index < 0:
+            output.append(line)
+            continue
+        output.append(line[:index])
+        return int(line[index + len(marker):]), ''.join(output)
+
+
+def _probe(device):
+    try:
+        return _shell_run(device, 'echo', device['probe_timeout'])[0] == 0
+    except OSError:
+        return False
+
+
+def _recover(device):
+    serial = device['serial']
+    _close_shell(device)
+    _mark_down(device)
+    for attempt in range(device['max_retries']):
+        if attempt:
+            time.sleep(device['retry_delay'])
+        subprocess.run(['adb', '-s', serial, 'reconnect'], capture_output=True)
+        try:
+            subprocess.run(['adb', '-s', serial, 'wait-for-device'], capture_output=True,
+                           timeout=device['wait_timeout'])
+            _open_shell(device)
+            if _shell_run(device, 'echo', device['probe_timeout'])[0] == 0:
+                device['reconnects'] += 1
+                device['state'] = 'device'
+                _mark_up(device)
+                return
+        except (subprocess.TimeoutExpired, OSError):
+            pass
+        _close_shell(device)
+    raise ConnectionError(f'Device {serial} did not come back after {device["max_retries"]} attempts')
+
+
+def _device(serial):
+    with _devices_lock:
+        assert serial in _devices, f'Device {serial} is not managed, call manage() first'
+        return _devices[serial]
+
+
+def _only_device():
+    serials = android.devices()
+    assert len(serials) == 1, f'Expected one connected device, found {len(serials)}'
+    return serials[0]
+
+
+def manage(serial=None, max_retries=3, wait_timeout=60, retry_delay=5, probe_timeout=5):
+    """
+    Starts managing a device: keeps a warm shell connection to it and recovers from disconnections.
+    :param serial: Device serial, or None for the only connected device.
+    :param max_retries: Reconnection attempts before giving up on the device.
+    :param wait_timeout: Seconds to wait for the device to come back online on each attempt.
+    :param retry_delay: Seconds between reconnection attempts.
+    :param probe_timeout: Seconds a health probe can take before the device is considered unresponsive.
+    :return: Device serial.
+    """
+    if serial is None:
+        serial = _only_device()
+    with _devices_lock:
+        if serial not in _devices:
+            _devices[serial] = {
+                'serial': serial,
+                'state': 'device',
+                'shell': None,
+                'lines': None,
+                'lock': threading.Lock(),
+                'max_retries': max_retries,
+                'wait_timeout': wait_timeout,
+                'retry_delay': retry_delay,
+                'probe_timeout': probe_timeout,
+                'reconnects': 0,
+                'downtime': 0.0,
+                'down_since': None
+            }
+    return serial
+
+
+def release(serial):
+    """
+    Stops managing a device, closing its shell connection.
+    If the android module was using it (see use()), it goes back to running adb directly for the only connected
+    device.
+    :param serial: Device serial.
+    :return: Nothing.
+    """
+    device = _device(serial)
+    with device['lock']:
+        _close_shell(device)
+    with _devices_lock:
+        del _devices[serial]
+    if android.device_serial == serial:
+        android.shell_runner = None
+        android.adb_runner = None
+        android.device_serial = None
+
+
+def shell(serial, command, timeout=60, retry=False):
+    """
+    Runs a shell command in a managed device through its warm connection.
+    If the connection is broken, waits for the device to come back (with bounded retries, see manage()). The command
+    is then run again if it never reached the device. If the command times out, the device is probed on a new
+    connection and only recovered if it doesn't answer either.
+    This will throw a ConnectionError if the device doesn't come back or the connection broke while running the
+    command, or a TimeoutError if the command times out.
+    :param serial: Device serial.
+    :param command: Shell command.
+    :param timeout: Seconds the command can take.
+    :param retry: If True runs the command again after the connection broke while running it or it timed out,
+    once the device is recovered. Leave it False for commands that are not safe to run twice.
+    :return: Tuple of (exit code, standard output).
+    """
+    device = _device(serial)
+    with device['lock']:
+        try:
+            return _shell_run(device, command, timeout)
+        except _CommandNotSent:
+            _recover(device)
+            return _shell_run(device, command, timeout)
+        except ConnectionError:
+            # The device might have run the command before the connection broke
+            _recover(device)
+            if not retry:
+                raise
+            return _shell_run(device, command, timeout)
+        except TimeoutError:
+            # The command might still be running in the old connection, or might just be slow
+            _close_shell(device)
+            if _probe(device):
+                raise
+            _recover(device)
+            if not retry:
+                raise
+            return _shell_run(device, command, timeout)
+
+
+def adb(serial, args):
+    """
+    Runs an adb command (e.g. ['install', '-r', apk_path]) against a managed device.
+    If the device can't be reached, waits for it to come back (with bounded retries, see manage()) and runs
+    the command again.
+    This will throw a ConnectionError if the device doesn't come back.
+    :param serial: Device serial.
+    :param args: List of adb arguments, without "adb -s <serial>".
+    :return: CompletedProcess, with stdout and stderr as bytes.
+    """
+    device = _device(serial)
+    command = ['adb', '-s', serial, *args]
+    with device['lock']:
+        result = subprocess.run(command, capture_output=True)
+        if result.returncode != 0 and _unreachable_pattern.search(result.stderr.decode(errors='replace')):
+            _recover(device)
+            result = subprocess.run(command, capture_output=True)
+        return result
+
+
+def use(serial=None):
+    """
+    Makes the android module send all its device commands to a managed device: shell commands through its warm
+    connection and the rest with "adb -s <serial>", all with automatic recovery. Streamed commands (logcat
+    readers, pull_tree()) go to the device too but are not recovered.
+    The device is managed with default settings if it wasn't already.
+    :param serial: Device serial, or None for the only connected device.
+    :return: Device serial.
+    """
+    serial = manage(serial)
+
+    def shell_runner(command):
+        return shell(serial, command)
+
+    def adb_runner(args):
+        return adb(serial, args)
+
+    android.shell_runner = shell_runner
+    android.adb_runner = adb_runner
+    android.device_serial = serial
+    return serial
+
+
+def refresh():
+    """
+    Updates the state of all managed devices from "adb devices".
+    :return: Dictionary of device serial to state ("device", "offline", "unauthorized"... or "missing").
+    """
+    states = {}
+    output = subprocess.run(['adb', 'devices'], capture_output=True, text=True).stdout
+    for line in output.split('\n')[1:]:
+        fields = line.split()
+        if len(fields) >= 2:
+            states[fields[0]] = fields[1]
+    with _devices_lock:
+        devices = list(_devices.values())
+    for device in devices:
+        device['state'] = states.get(device['serial'], 'missing')
+        if device['state'] == 'device':
+            if not device['lock'].locked():
+                _mark_up(device)
+        else:
+            _mark_down(device)
+    return {device['serial']: device['state'] for device in devices}
+
+
+def _check_health(device):
+    if not device['lock'].acquire(blocking=False):
+        # Busy running a command, which is a health check on its own
+        return
+    try:
+        if device['state'] == 'device' and _probe(device):
+            return
+        _recover(device)
+    except ConnectionError:
+        # Reported in stats(), next probe tries again
+        pass
+    finally:
+        device['lock'].release()
+
+
+def _watch(stop, interval):
+    while not stop.wait(interval):
+        refresh()
+        with _devices_lock:
+            devices = list(_devices.values())
+        for device in devices:
+            _check_health(device)
+
+
+def start_watchdog(interval=10):
+    """
+    Starts probing the health of all managed devices in the background, recovering unresponsive ones.
+    :param interval: Seconds between probes.
+    :return: Nothing.
+    """
+    if _watchdog['thread'] is not None:
+        return
+    stop = threading.Event()
+    thread = threading.Thread(target=_watch, args=(stop, interval), daemon=True)
+    thread.start()
+    _watchdog['stop'] = stop
+    _watchdog['thread'] = thread
+
+
+def stop_watchdog():
+    """
+    Stops probing the health of managed devices.
+    :return: Nothing.
+    """
+    if _watchdog['thread'] is None:
+        return
+    _watchdog['stop'].set()
+    _watchdog['thread'].join()
+    _watchdog['stop'] = None
+    _watchdog['thread'] = None
+
+
+def stats():
+    """
+    Returns health statistics of all managed devices.
+    :return: Dictionary of device serial to dictionary with "state", "reconnects" (successful recoveries),
+    "downtime" (seconds the device was not usable, including the current outage) and "down" (True if not usable now).
+    """
+    now = time.monotonic()
+    with _devices_lock:
+        devices = list(_devices.values())
+    result = {}
+    for device in devices:
+        down_since = device['down_since']
+        result[device['serial']] = {
+            'state': device['state'],
+            'reconnects': device['reconnects'],
+            'downtime': device['downtime'] + (now - down_since if down_since is not None else 0),
+            'down': down_since is not None
+        }
+    return result
@@ -0,0 +1,199 @@
+import os
+import tempfile
+
+import numpy as np
+from PIL import Image
+
+from pytomation import android
+
+# Smallest template side (in pixels) the coarsest pyramid level is allowed to shrink the template to, smaller
+# templates lose the details that tell similar UI elements apart
+_MIN_TEMPLATE_SIZE = 16
+# Most matches of the coarsest pyramid level refined at full resolution
+_MAX_CANDIDATES = 50
+# Matches of the coarsest pyramid level scoring less than this fraction of the best one are not refined
+_CANDIDATE_FRACTION = 0.7
+# Pixels around each candidate searched again on every finer pyramid level
+_REFINE_MARGIN = 8
+
+_template_cache = {}
+
+
+def _to_gray(image):
+    return np.asarray(image.convert('L'), dtype=np.float64)
+
+
+def _downscale(array):
+    h = array.shape[0] // 2 * 2
+    w = array.shape[1] // 2 * 2
+    array = array[:h, :w]
+    return (array[0::2, 0::2] + array[1::2, 0::2] + array[0::2, 1::2] + array[1::2, 1::2]) / 4
+
+
+def _pyramid(array, levels):
+    pyramid = [array]
+    for _ in range(levels):
+        pyramid.append(_downscale(pyramid[-1]))
+    return pyramid
+
+
+def _template_pyramid(template, scale):
+    if isinstance(template, str):
+        key = (os.path.abspath(template), os.path.getmtime(template), scale)
+        if key not in _template_cache:
+            _template_cache[key] = _template_pyramid(Image.open(template), scale)
+        return _template_cache[key]
+    if scale != 1:
+        size = (max(1, round(template.width * scale)), max(1, round(template.height * scale)))
+        template = template.resize(size, Image.BILINEAR)
+    array = _to_gray(template)
+    levels = 0
+    while min(array.shape) >> (levels + 1) >= _MIN_TEMPLATE_SIZE:
+        levels += 1
+    return _pyramid(array, levels)
+
+
+def _window_sums(array, h, w):
+    sums = np.zeros((array.shape[0] + 1, array.shape[1] + 1))
+    sums[1:, 1:] = array.cumsum(0).cumsum(1)
+    return sums[h:, w:] - sums[:-h, w:] - sums[h:, :-w] + sums[:-h, :-w]
+
+
+# Normalized cross-correlation of template over every position of image, computed with FFTs and summed-area tables.
+# Result shape is (image height - template height + 1, image width - template width + 1), values in [-1, 1].
+def _match(image, template):
+    h, w = template.shape
+    H, W = image.shape
+    t = template - template.mean()
+    t_norm = np.sqrt((t * t).sum())
+    if t_norm == 0:
+        return np.zeros((H - h + 1, W - w + 1))
+    shape = (H + h - 1, W + w - 1)
+    corr = np.fft.irfft2(np.fft.rfft2(image, shape) * np.fft.rfft2(t[::-1, ::-1], shape), shape)[h - 1:H, w - 1:W]
+    sums = _window_sums(image, h, w)
+    variance = _window_sums(image * image, h, w) - sums * sums / (h * w)
+    # Flat windows (almost no variance) can't match a non flat template, and would divide by ~0
+    flat = variance < 1e-2 * h * w
+    denominator = np.sqrt(np.where(flat, 1, variance)) * t_norm
+    return np.clip(np.where(flat, 0, corr / denominator), -1, 1)
+
+
+def _best_positions(scores, count, radius, min_score):
+    scores = scores.copy()
+    positions = []
+    for _ in range(count):
+        y, x = np.unravel_index(np.argmax(scores), scores.shape)
+        if positions and scores[y, x] < min_score:
+            break
+        positions.append((int(x), int(y)))
+        scores[max(y - radius, 0):y + radius + 1, max(x - radius, 0):x + radius + 1] = -np.inf
+    return positions
+
+
+# The first finer level is searched around the whole area the candidate stands for, since weaker peaks next to it
+# were not made candidates (see _best_positions()).
+def _refine(image_pyramid, template_pyramid, coarse_level, x, y, radius):
+    score = -1
+    margin = 2 * radius + _REFINE_MARGIN
+    for level in range(coarse_level - 1, -1, -1):
+        image = image_pyramid[level]
+        template = template_pyramid[level]
+        h, w = template.shape
+        x0 = max(2 * x - margin, 0)
+        y0 = max(2 * y - margin, 0)
+        x1 = min(2 * x + margin + w, image.shape[1])
+        y1 = min(2 * y + margin + h, image.shape[0])
+        if x1 - x0 < w or y1 - y0 < h:
+            return -1, x, y
+        scores = _match(image[y0:y1, x0:x1], template)
+        dy, dx = np.unravel_index(np.argmax(scores), scores.shape)
+        score = scores[dy, dx]
+        x = x0 + int(dx)
+        y = y0 + int(dy)
+        margin = _REFINE_MARGIN
+    return score, x, y
+
+
+def _find_in(image, template_pyramid, threshold):
+    levels = len(template_pyramid) - 1
+    while levels and any(i >> levels < t for i, t in zip(image.shape, template_pyramid[levels].shape)):
+        levels -= 1
+    if any(i < t for i, t in zip(image.shape, template_pyramid[0].shape)):
+        return None
+    image_pyramid = _pyramid(image, levels)
+    template = template_pyramid[levels]
+    scores = _match(image_pyramid[levels], template)
+    if levels == 0:
+        y, x = np.unravel_index(np.argmax(scores), scores.shape)
+        return scores[y, x], int(x), int(y)
+    radius = max(1, min(template.shape) // 2)
+    min_score = scores.max() * _CANDIDATE_FRACTION
+    best = max(_refine(image_pyramid, template_pyramid, levels, x, y, radius)
+               for x, y in _best_positions(scores, _MAX_CANDIDATES, radius, min_score))
+    if best[0] < threshold:
+        # The match might have been lost at the coarse levels, make sure with a full resolution search
+        scores = _match(image, template_pyramid[0])
+        y, x = np.unravel_index(np.argmax(scores), scores.shape)
+        best = scores[y, x], int(x), int(y)
+    return best
+
+
+def find_template(template, screenshot_path=None, region=None, scales=(1.0,), threshold=0.8):
+    """
+    Finds the best match of a template image (e.g. an icon) in a screenshot, without OCR nor view hierarchy.
+    Useful for games and canvas views. Template images loaded from a path are cached between calls.
+    :param template: Path of the template image, or PIL image.
+    :param screenshot_path: Path of the screenshot to look in, or None to take a new screenshot.
+    :param region: Region of the screenshot to look in as (left, top, right, bottom) in pixels, or None for all of it.
+    :param scales: Template scales to try, e.g. (0.75, 1.0, 1.5) if the template was captured on another density.
+    :param threshold: Minimum match score, from -1 to 1 (1 being a perfect match).
+    :return: Dictionary with "score", "bounds" ((x1, y1), (x2, y2)) and "center" (x, y) of the match,
+    or None if no match is at least as good as threshold.
+    """
+    if screenshot_path is None:
+        with tempfile.TemporaryDirectory() as directory:
+            screenshot_path = os.path.join(directory, 'screenshot.png')
+            android.screenshot(screenshot_path)
+            return find_template(template, screenshot_path, region, scales, threshold)
+    image = Image.open(screenshot_path)
+    left, top = 0, 0
+    if region is not None:
+        image = image.crop(region)
+        left, top = region[0], region[1]
+    image = _to_gray(image)
+    best = None
+    for scale in scales:
+        template_pyramid = _template_pyramid(template, scale)
+        found = _find_in(image, template_pyramid, threshold)
+        if found is not None and (best is None or found[0] > best[0]):
+            best = found + template_pyramid[0].shape
+    if best is None or best[0] < threshold:
+        return None
+    score, x, y, h, w = best
+    x1 = left + x
+    y1 = top + y
+    return {
+        'score': float(score),
+        'bounds': ((x1, y1), (x1 + w, y1 + h)),
+        'center': (x1 + w // 2, y1 + h // 2)
+    }
+
+
+def tap_template(template, screenshot_path=None, region=None, scales=(1.0,), threshold=0.8):
+    """
+    Taps the best match of a template image in the screen.
+    See find_template() for the parameters.
+    :return: True if the template was found, False otherwise.
+    """
+    found = find_template(template, screenshot_path, region, scales, threshold)
+    if found is None:
+        return False
+    return android.tap(*found['center'])
+
+
+def clear_template_cache():
+    """
+    Clears the cache of template images loaded by find_template().
+    :return: Nothing.
+    """
+    _template_cache.clear()
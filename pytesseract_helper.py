@@ -1,20 +1,55 @@
-import pytesseract
-from PIL import Image
+import hashlib
 
-from pytomation import android
+
+# Image content hash to OCR boxes, so processing the same frame again skips OCR. Boxes are kept as returned by
+# tesseract because the elements depend on the display height too, which changes when the screen rotates.
+_ocr_cache = {}
+_OCR_CACHE_SIZE = 16
+
+_screen_cache = {
+    'fingerprint': None,
+    'elements': None
+}
 
 
 def process_image(path):
     """
     Processes image in OCR and returns its text elements as a list of dictionaries.
+    OCR results are cached by image content, so processing an identical image again skips OCR.
     :param path: Path to the image.
     :return: List of image elements.
     """
-    raw_data = pytesseract.image_to_boxes(Image.open(path))
-    return _raw_data_to_elements(raw_data)
+    with open(path, 'rb') as f:
+        key = hashlib.md5(f.read()).hexdigest()
+    if key not in _ocr_cache:
+        import pytesseract
+        from PIL import Image
+        raw_data = pytesseract.image_to_boxes(Image.open(path))
+        if len(_ocr_cache) >= _OCR_CACHE_SIZE:
+            del _ocr_cache[next(iter(_ocr_cache))]
+        _ocr_cache[key] = raw_data
+    return _raw_data_to_elements(_ocr_cache[key])
+
+
+def process_screen(file_name='../screenshot.png'):
+    """
+    Takes a screenshot and processes it in OCR, unless the screen didn't change since the last call.
+    In that case the previous elements are returned without taking a screenshot or running OCR.
+    :param file_name: File name where to store the screenshot.
+    :return: List of image elements.
+    """
+    from pytomation import android
+    fingerprint = android.screen_fingerprint()
+    if fingerprint != _screen_cache['fingerprint']:
+        android.screenshot(file_name)
+        _screen_cache['elements'] = process_image(file_name)
+        _screen_cache['fingerprint'] = fingerprint
+    # Copies, so changes made by the caller don't show up in the next calls
+    return [dict(element) for element in _screen_cache['elements']]
 
 
 def _raw_data_to_elements(raw_data):
+    from pytomation import android
     split_by_char = list(filter(lambda x: x, raw_data.split('\n')))
     elements = list(map(_line_to_element, split_by_char))
     y_axis_size = android.display_height()
@@ -44,6 +79,76 @@ def _fix_element_y_coordinates(element, max_y):
     return element
 
 
+def _init_ocr_worker():
+    # Imports OCR modules and resolves the tesseract binary once per worker process instead of once per image
+    import pytesseract
+    pytesseract.get_tesseract_version()
+
+
+# Same correction as _fix_element_y_coordinates (plus X offset for regions), applied to all boxes in a single pass
+def _boxes_to_elements(raw_data, x_offset, max_y):
+    boxes = [line.split(' ') for line in raw_data.split('\n') if line]
+    return [{
+        'char': box[0],
+        'bottom-left': (x_offset + int(box[1]), max_y - int(box[2])),
+        'top-right': (x_offset + int(box[3]), max_y - int(box[4]))
+    } for box in boxes]
+
+
+def _process_image_region(image, max_y):
+    import pytesseract
+    from PIL import Image
+    if isinstance(image, tuple):
+        path, region = image
+        raw_data = pytesseract.image_to_boxes(Image.open(path).crop(region))
+        # Tesseract Y coordinates are relative to the bottom of the cropped region
+        return _boxes_to_elements(raw_data, region[0], region[3])
+    raw_data = pytesseract.image_to_boxes(Image.open(image))
+    return _boxes_to_elements(raw_data, 0, max_y)
+
+
+_ocr_pool = None
+
+
+def _get_ocr_pool(max_workers):
+    global _ocr_pool
+    if _ocr_pool is None:
+        from concurrent.futures import ProcessPoolExecutor
+        _ocr_pool = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_ocr_worker)
+    return _ocr_pool
+
+
+def process_images(images, max_workers=None):
+    """
+    Processes several images, or regions of images, in OCR in parallel worker processes.
+    Worker processes are kept alive between calls (see shutdown_ocr_pool()).
+    :param images: List of image paths, or of (image path, region) tuples where region is (left, top, right, bottom)
+    in pixels. Coordinates of elements found in a region are relative to the whole image.
+    :param max_workers: Number of worker processes, or None for one per CPU. Only used when the workers are started.
+    :return: Iterator of (index in images, list of image elements) tuples, yielded as soon as each image is processed.
+    """
+    from concurrent.futures import as_completed
+    from pytomation import android
+    max_y = None
+    if any(not isinstance(image, tuple) for image in images):
+        max_y = android.display_height()
+    pool = _get_ocr_pool(max_workers)
+    futures = {pool.submit(_process_image_region, image, max_y): index for index, image in enumerate(images)}
+    for future in as_completed(futures):
+        yield futures[future], future.result()
+
+
+def shutdown_ocr_pool():
+    """
+    Stops the OCR worker processes started by process_images().
+    :return: Nothing.
+    """
+    global _ocr_pool
+    if _ocr_pool is not None:
+        _ocr_pool.shutdown()
+        _ocr_pool = None
+
+
 def click_coordinates_for_char(elements, char):
     """
     Returns click coordinates for the specified character (first appearance).
@@ -0,0 +1,273 @@
+from datetime import datetime
+import gzip
+import json
+import math
+import re
+import subprocess
+import threading
+import time
+
+from pytomation import android
+from pytomation import charles
+
+# Trace file thread ids, one per event source, so each source gets its own track in trace viewers
+_trace_tids = {
+    'input': 1,
+    'screenshot': 2,
+    'foreground': 3,
+    'charles': 4,
+    'logcat': 5,
+    'mark': 6
+}
+
+_logcat_pattern = re.compile(r'^\s*(\d+\.\d+)\s+(\d+)\s+(\d+)\s+([VDIWEFA])\s+(.*?)\s*: (.*)$')
+
+_recording = {
+    'running': False,
+    'events': [],
+    'start': None,
+    'wall_offset': None,
+    'logcat': None,
+    'logcat_thread': None,
+    'foreground_tracker': False,
+    'charles': False
+}
+_events_lock = threading.Lock()
+
+
+def _add_event(event_time, source, name, args, end=None):
+    event = {
+        'time': event_time,
+        'source': source,
+        'name': name,
+        'args': args
+    }
+    if end is not None:
+        event['end'] = end
+    with _events_lock:
+        _recording['events'].append(event)
+
+
+def _on_android_event(event, details):
+    now = time.monotonic()
+    if event == 'input':
+        words = details['command'].split(' ')
+        name = words[2] if words[1] == 'touchscreen' else words[1]
+        _add_event(now, 'input', name, details)
+    else:
+        _add_event(now, event, event, details)
+
+
+# Device wall clock minus host monotonic clock, assuming the adb round trip is symmetric
+def _device_clock():
+    before = time.monotonic()
+    output = android._adb_shell_check_output('date +%s.%N')
+    after = time.monotonic()
+    if not re.fullmatch(r'\d+\.\d+', output):
+        # No nanoseconds support in this device date
+        output = output.split('.')[0]
+    device_time = float(output)
+    return device_time, device_time - (before + after) / 2
+
+
+def _read_logcat(process, device_offset, logcat_filter):
+    for line in process.stdout:
+        match = _logcat_pattern.match(line)
+        if match is None or (logcat_filter is not None and not logcat_filter.search(line)):
+            continue
+        _add_event(float(match.group(1)) - device_offset, 'logcat', match.group(5), {
+            'pid': int(match.group(2)),
+            'level': match.group(4),
+            'message': match.group(6)
+        })
+
+
+def _iso_to_monotonic(value):
+    return datetime.fromisoformat(value).timestamp() - _recording['wall_offset']
+
+
+def _add_charles_entries():
+    for entry in charles.get_session_entries():
+        times = entry.get('times') or {}
+        if not times.get('start'):
+            continue
+        start = _iso_to_monotonic(times['start'])
+        if start < _recording['start']:
+            continue
+        end = _iso_to_monotonic(times['end']) if times.get('end') else start
+        _add_event(start, 'charles', f'{entry.method} {entry.host}{entry.path}', {
+            'method': entry.method,
+            'host': entry.host,
+            'path': entry.path,
+            'status': entry.status
+        }, end)
+
+
+def start_recording(logcat=True, logcat_filter=None, foreground=True, charles_session=True):
+    """
+    Starts recording a timeline of input events, screenshots, foreground activity changes, logcat records and
+    Charles session entries, all on the host monotonic clock.
+    Device times (logcat) are aligned to the host clock when the recording starts, with adb round trip precision.
+    :param logcat: If True records logcat.
+    :param logcat_filter: Regular expression logcat lines must match to be recorded, or None to record all of them.
+    :param foreground: If True records foreground activity changes (starts the Android foreground tracker).
+    :param charles_session: If True records Charles session entries started after this call (read when stopping).
+    :return: Nothing.
+    """
+    assert not _recording['running']
+    if logcat_filter is not None:
+        logcat_filter = re.compile(logcat_filter)
+    _recording['events'] = []
+    _recording['start'] = time.monotonic()
+    _recording['wall_offset'] = time.time() - time.monotonic()
+    _recording['charles'] = charles_session
+    android.event_listeners.append(_on_android_event)
+    try:
+        if foreground and not android._foreground_tracker_running():
+            android.start_foreground_tracker()
+            _recording['foreground_tracker'] = True
+        if logcat:
+            device_time, device_offset = _device_clock()
+            process = subprocess.Popen(android._adb('logcat', '-v', 'epoch', '-T', f'{device_time:.3f}'),
+                                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True, errors='replace')
+            thread = threading.Thread(target=_read_logcat, args=(process, device_offset, logcat_filter), daemon=True)
+            thread.start()
+            _recording['logcat'] = process
+            _recording['logcat_thread'] = thread
+    except BaseException:
+        # Leave nothing half started, so recording can be started again
+        _stop_sources()
+        raise
+    _recording['running'] = True
+
+
+def _stop_sources():
+    android.event_listeners.remove(_on_android_event)
+    if _recording['foreground_tracker']:
+        android.stop_foreground_tracker()
+        _recording['foreground_tracker'] = False
+    if _recording['logcat'] is not None:
+        _recording['logcat'].kill()
+        _recording['logcat'].wait()
+        _recording['logcat_thread'].join()
+        _recording['logcat'] = None
+        _recording['logcat_thread'] = None
+
+
+def stop_recording():
+    """
+    Stops recording the timeline.
+    If the Charles session can't be read, the recording is stopped anyway before the error is raised, and events()
+    still returns everything else that was recorded.
+    :return: Recorded events, as returned by events().
+    """
+    assert _recording['running']
+    try:
+        _stop_sources()
+        if _recording['charles']:
+            _add_charles_entries()
+    finally:
+        _recording['running'] = False
+    return events()
+
+
+def mark(name, **args):
+    """
+    Adds a custom event to the timeline being recorded, e.g. mark('login done').
+    :param name: Event name.
+    :param args: Event details.
+    :return: Nothing.
+    """
+    _add_event(time.monotonic(), 'mark', name, args)
+
+
+def events():
+    """
+    Returns the recorded events, sorted by time.
+    Each event is a dictionary with "time" (host monotonic seconds), "source" ("input", "screenshot", "foreground",
+    "logcat", "charles" or "mark"), "name" and "args" keys. Charles events also have "end".
+    :return: List of events.
+    """
+    with _events_lock:
+        return sorted(_recording['events'], key=lambda event: event['time'])
+
+
+def export_trace(file_name):
+    """
+    Exports the recorded events as a compact Chrome trace event file (viewable in Perfetto or chrome://tracing),
+    with times relative to the start of the recording. The file is gzip compressed if its name ends in ".gz".
+    :param file_name: Trace file name.
+    :return: Nothing.
+    """
+    recorded = events()
+    start = _recording['start']
+    trace = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': source}}
+             for source, tid in _trace_tids.items()]
+    for event in recorded:
+        trace_event = {
+            'name': event['name'],
+            'cat': event['source'],
+            'ts': round((event['time'] - start) * 1e6),
+            'pid': 1,
+            'tid': _trace_tids[event['source']],
+            'args': event['args']
+        }
+        if 'end' in event:
+            trace_event['ph'] = 'X'
+            trace_event['dur'] = round((event['end'] - event['time']) * 1e6)
+        else:
+            trace_event['ph'] = 'i'
+            trace_event['s'] = 't'
+        trace.append(trace_event)
+    content = json.dumps({'traceEvents': trace}, separators=(',', ':')).encode()
+    if file_name.endswith('.gz'):
+        content = gzip.compress(content)
+    with open(file_name, 'wb') as f:
+        f.write(content)
+
+
+def _requests(recorded, path, host):
+    return [event for event in recorded if event['source'] == 'charles' and
+            (path is None or event['args']['path'] == path) and
+            (host is None or event['args']['host'] == host)]
+
+
+def tap_to_request_latencies(path=None, host=None):
+    """
+    Returns, for each input event (tap, swipe, key...), seconds until the first matching request started,
+    if it started before the next input event.
+    :param path: Request path, or None for any path.
+    :param host: Request host, or None for any host.
+    :return: List of latencies in seconds.
+    """
+    recorded = events()
+    inputs = [event for event in recorded if event['source'] == 'input']
+    requests = _requests(recorded, path, host)
+    latencies = []
+    for i, event in enumerate(inputs):
+        next_input = inputs[i + 1]['time'] if i + 1 < len(inputs) else math.inf
+        request = next((request for request in requests if event['time'] <= request['time'] < next_input), None)
+        if request is not None:
+            latencies.append(request['time'] - event['time'])
+    return latencies
+
+
+def request_to_render_latencies(path=None, host=None, render_pattern=r'Displayed |Fully drawn'):
+    """
+    Returns, for each matching request, seconds from its end until the next render: a foreground activity change
+    or a logcat record matching render_pattern (by default the activity "Displayed" and "Fully drawn" records).
+    :param path: Request path, or None for any path.
+    :param host: Request host, or None for any host.
+    :param render_pattern: Regular expression for logcat messages considered a render.
+    :return: List of latencies in seconds.
+    """
+    recorded = events()
+    render_pattern = re.compile(render_pattern)
+    renders = [event for event in recorded if event['source'] == 'foreground' or
+               (event['source'] == 'logcat' and render_pattern.search(event['args']['message']))]
+    latencies = []
+    for request in _requests(recorded, path, host):
+        render = next((render for render in renders if render['time'] >= request['end']), None)
+        if render is not None:
+            latencies.append(render['time'] - request['end'])
+    return latencies